@@ -1,25 +1,30 @@
 import json
 import os
-import sqlite3
 import sys
 import stashapi.log as log
-from stashapi.stashapp import StashInterface
-from performer import process_all_performers
-from scene import process_all_scenes, process_scene
 from utils.settings import read_settings, update_setting
 
 # json context payload passed to us from Stash when any plugin is triggered
 json_input = json.loads(sys.stdin.read())
-# initialize Stash API module
-stash = StashInterface(json_input["server_connection"])
-
 
 PLUGIN_ARGS = json_input["args"]
 SETTINGS_FILEPATH = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "settings.ini"
 )
-SETTINGS = read_settings(SETTINGS_FILEPATH)
 SETTINGS_MODES = ["disable", "dryrun", "enable", "renamer"]
+# modes that flip a boolean setting: (setting, name used in the log)
+SETTINGS_TOGGLES = {
+    "dryrun": ("dry_run", "dry run"),
+    "renamer": ("enable_renamer", "renamer"),
+}
+# per-connection settings only, the journal mode of Stash's database is left to Stash
+SQLITE_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    # wait for Stash to release its locks instead of failing with "database is locked"
+    "PRAGMA busy_timeout=30000",
+]
 
 
 def __get_plugin_mode():
@@ -35,6 +40,7 @@ def __get_plugin_mode():
 # if triggered via one of the plugin tasks in the UI
 mode = __get_plugin_mode()
 log.debug(f"Initializing plugin with args: {str(PLUGIN_ARGS)}")
+SETTINGS = read_settings(SETTINGS_FILEPATH)
 DRY_RUN = SETTINGS["dry_run"]
 if mode in SETTINGS_MODES:
     match mode:
@@ -44,33 +50,51 @@ if mode in SETTINGS_MODES:
         case "disable":
             log.info("Disabling hooks")
             update_setting(SETTINGS_FILEPATH, "enable_hook", "false")
-        case "dryrun":
-            if DRY_RUN is True:
-                log.info("Disabling dry run")
-                update_setting(SETTINGS_FILEPATH, "dry_run", "false")
-            else:
-                log.info("Enabling dry run")
-                update_setting(SETTINGS_FILEPATH, "dry_run", "true")
-        case "renamer":
-            if SETTINGS["enable_renamer"] is True:
-                log.info("Disabling renamer")
-                update_setting(SETTINGS_FILEPATH, "enable_renamer", "false")
-            else:
-                log.info("Enabling renamer")
-                update_setting(SETTINGS_FILEPATH, "enable_renamer", "true")
+        case "dryrun" | "renamer":
+            key, name = SETTINGS_TOGGLES[mode]
+            enabled = SETTINGS[key] is not True
+            log.info(f"{'Enabling' if enabled else 'Disabling'} {name}")
+            update_setting(SETTINGS_FILEPATH, key, str(enabled).lower())
+    sys.exit(0)
+
+
+# the hook fires on every scene update, bail out before doing any setup when it's disabled
+if mode == "Scene.Update.Post" and not SETTINGS["enable_hook"]:
+    log.debug("Hook disabled")
     sys.exit(0)
 
+# only imported now, the settings toggles and a disabled hook exit before needing any of these
+import sqlite3
+from stashapi.stashapp import StashInterface
+from performer import process_all_performers
+from scene import (
+    SCENE_FRAGMENT,
+    flush_db_updates,
+    process_all_scenes,
+    process_scene,
+)
 
-# establish db connection
-try:
-    stash_config = stash.get_configuration()["general"]
-    api_key = stash_config["apiKey"]
-    sqliteConnection = sqlite3.connect(stash_config["databasePath"])
-    cursor = sqliteConnection.cursor()
-    log.debug("Successfully connected to database")
-except sqlite3.Error as error:
-    log.error("FATAL SQLITE Error: ", error)
-    sys.exit(1)
+# initialize Stash API module
+stash = StashInterface(json_input["server_connection"])
+stash_config = stash.get_configuration()["general"]
+api_key = stash_config["apiKey"]
+
+# establish db connection, the database is only written to when renaming files
+sqliteConnection = None
+cursor = None
+if mode != "performers" and SETTINGS["enable_renamer"] is True:
+    try:
+        # the IN queries for folder lookups vary in length, keep room for all of their variants
+        sqliteConnection = sqlite3.connect(
+            stash_config["databasePath"], cached_statements=256
+        )
+        for pragma in SQLITE_PRAGMAS:
+            sqliteConnection.execute(pragma)
+        cursor = sqliteConnection.cursor()
+        log.debug("Successfully connected to database")
+    except sqlite3.Error as error:
+        log.error(f"FATAL SQLITE Error: {str(error)}")
+        sys.exit(1)
 
 log.debug(f"Dry Run: {str(DRY_RUN)}")
 
@@ -82,21 +106,16 @@ match mode:
         log.info("Running bulk performer updater")
         process_all_performers(stash, SETTINGS, api_key)
     case "Scene.Update.Post":
-        if not SETTINGS["enable_hook"]:
-            log.debug("Hook disabled")
-            sys.exit(0)
-
         scene_id = PLUGIN_ARGS["hookContext"]["id"]
-        scene = stash.find_scene(scene_id)
+        scene = stash.find_scene(scene_id, SCENE_FRAGMENT)
         stash_ids = scene["stash_ids"]
         if stash_ids is not None and len(stash_ids) > 0:
             log.info("Running scene updater")
-            process_scene(scene, stash, SETTINGS, cursor, api_key)
+            process_scene(scene, SETTINGS, api_key)
+            flush_db_updates(SETTINGS, cursor)
 
 
-# commit db changes & cleanup
-if DRY_RUN is False:
-    log.debug("Committing database changes")
-    sqliteConnection.commit()
-cursor.close()
-sqliteConnection.close()
+# cleanup, db changes are committed as they're flushed
+if sqliteConnection is not None:
+    cursor.close()
+    sqliteConnection.close()
@@ -1,53 +1,96 @@
+from functools import lru_cache
+from itertools import count
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import stashapi.log as log
-from utils.files import download_image
+from utils.files import (
+    DOWNLOAD_WORKERS,
+    download_image,
+    ensure_dir,
+    file_exists,
+    set_download_workers,
+)
+from utils.pages import prefetch_pages
 
 # Constants
 BATCH_SIZE = 100
+# ids of performers already handled during this run, they show up in many scenes
+__processed_performers = set()
+__processed_lock = threading.Lock()
+# only the fields process_performer reads, the default fragment pulls in far more per performer
+PERFORMER_FRAGMENT = """
+id
+name
+image_path
+"""
+# how each media server names the folder a performer's folder is grouped under
+ACTOR_IMAGE_BUCKETS = {
+    "jellyfin": lambda first_letter: first_letter,
+    "emby": str.lower,
+}
 
 
 def process_all_performers(stash, settings, api_key):
-    count = stash.find_performers(
-        f={},
-        filter={"per_page": 1},
-        get_count=True,
-    )[0]
-
-    log.debug(f"{str(count)} performers to scan.")
-
-    for r in range(1, int(count / BATCH_SIZE) + 1):
-        start = r * BATCH_SIZE
-        end = start + BATCH_SIZE
-        if end > count:
-            end = count
+    # don't page through every performer just to skip each of them
+    if settings["enable_actor_images"] is False:
+        log.info("Skipping performer images because they're disabled in settings")
+        return
+
+    # keep requesting pages until a short one comes back instead of counting performers first
+    pages = prefetch_pages(
+        lambda page: stash.find_performers(
+            f={},
+            filter={"page": page, "per_page": BATCH_SIZE},
+            fragment=PERFORMER_FRAGMENT,
+        ),
+        count(1),
+        BATCH_SIZE,
+    )
 
-        log.debug(f"Processing {str(start)}-{str(end)}")
+    # values read from settings.ini are strings
+    download_workers = int(settings.get("download_concurrency") or DOWNLOAD_WORKERS)
+    set_download_workers(download_workers)
 
-        performers = stash.find_performers(
-            f={},
-            filter={"page": r, "per_page": BATCH_SIZE},
-        )
+    for r, performers in pages:
+        log.debug(f"Processing page {r}")
 
-        for performer in performers:
-            process_performer(performer, settings, api_key, True)
+        # downloads are I/O bound, so overlap them instead of waiting on each one
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            for performer in performers:
+                executor.submit(process_performer, performer, settings, api_key, True)
 
 
 def process_performer(performer, settings, api_key, overwrite=False):
+    if settings["enable_actor_images"] is False:
+        return
+
     try:
         log.debug(f"Processing performer {performer['name']}")
-        if settings["enable_actor_images"] is False:
-            return
+        with __processed_lock:
+            if performer["id"] in __processed_performers:
+                log.debug(f"Skipping performer {performer['name']}, already processed")
+                return
+            # claimed up front so concurrent scenes don't fetch the same image, and given
+            # back below when handling it fails
+            __processed_performers.add(performer["id"])
 
         if performer["image_path"]:
-            image_path = __get_actor_image_path(performer["name"], settings)
-            image_url = f"{performer['image_path']}&apikey={api_key}"
-            dir = os.path.dirname(image_path)
-
-            if not os.path.exists(dir) and settings["dry_run"] is False:
-                os.makedirs(dir)
-
-            if overwrite is True or not os.path.exists(image_path):
-                download_image(image_url, image_path, settings)
+            dry_run = settings["dry_run"]
+            image_path = __get_actor_image_path(
+                performer["name"],
+                settings["media_server"],
+                settings["actor_metadata_path"],
+            )
+            performer_dir = os.path.dirname(image_path)
+            # the letter directory is listed once for all of its performers, so performers
+            # without a folder yet don't need a listing of their own
+            if overwrite is True or not (
+                file_exists(performer_dir) and file_exists(image_path)
+            ):
+                if dry_run is False:
+                    ensure_dir(performer_dir)
+                download_image(performer["image_path"], image_path, settings, api_key)
         else:
             log.debug(
                 f"Skipping performer {performer['name']} because they have no image_path"
@@ -55,11 +98,13 @@ def process_performer(performer, settings, api_key, overwrite=False):
 
     except Exception as err:
         log.error(f"Error processing Performer {performer['name']}: {str(err)}")
+        # let another scene of this run try the performer again
+        with __processed_lock:
+            __processed_performers.discard(performer["id"])
 
 
-def __get_actor_image_path(performer_name, settings):
-    match settings["media_server"]:
-        case "jellyfin":
-            return f"{settings['actor_metadata_path']}{performer_name[0]}{os.path.sep}{performer_name}{os.path.sep}folder.jpg"
-        case "emby":
-            return f"{settings['actor_metadata_path']}{performer_name[0].lower()}{os.path.sep}{performer_name}{os.path.sep}folder.jpg"
+# performers show up in many scenes, only build each image path once
+@lru_cache(maxsize=4096)
+def __get_actor_image_path(performer_name, media_server, actor_metadata_path):
+    bucket = ACTOR_IMAGE_BUCKETS[media_server](performer_name[0])
+    return f"{actor_metadata_path}{bucket}{os.path.sep}{performer_name}{os.path.sep}folder.jpg"
@@ -1,13 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import math
 import os
+import threading
 import stashapi.log as log
 from performer import process_performer
-from utils.files import download_image, rename_file, replace_file_ext
+from utils.files import (
+    DOWNLOAD_WORKERS,
+    clear_dir_cache,
+    dir_exists,
+    download_image,
+    file_exists,
+    rename_file,
+    write_file_if_changed,
+)
 from utils.nfo import build_nfo_xml
+from utils.pages import prefetch_pages
 from utils.replacer import get_new_path
 
-BATCH_SIZE = 100
+BATCH_SIZE = 500
+# default max number of scenes of a page processed at the same time
+SCENE_WORKERS = 8
+# performer images and posters of every scene are downloaded by one shared pool, sized to the
+# session's connection pool so a download never waits on a pooled connection
+__image_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
 IMPOSSIBLE_PATH = "$%^&@"
+# folders (path -> id) already looked up or inserted, see __get_folder_ids
+__folder_ids = {}
+# files renamed by the worker threads (scene id, old path, new path). the database is only
+# touched from the main thread, which applies these once per page in flush_db_updates
+__pending_renames = []
+# database writes built from the renames above
+__pending_files = []
+__pending_organized = []
+# renaming checks for collisions before moving files, so only one worker thread may do it at a time
+__rename_lock = threading.Lock()
+# base paths (without extension) files are being moved to. a move can be a slow copy to another
+# drive, so it runs outside of __rename_lock and its destination stays taken until it's done
+__renames_in_progress = set()
 QUERY_WHERE_STASH_ID_NOT_NULL = {
     "stash_id_endpoint": {
         "endpoint": "",
@@ -15,106 +45,195 @@ QUERY_WHERE_STASH_ID_NOT_NULL = {
         "stash_id": "",
     }
 }
+SQL_SELECT_FOLDERS_BY_PATH = "SELECT id, path FROM folders WHERE path IN ({});"
+SQL_INSERT_FOLDER = "INSERT INTO 'main'.'folders'('path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?);"
+SQL_SELECT_SCENE_FILE_IN_FOLDER = "SELECT sf.file_id FROM scenes_files sf JOIN files f ON f.id = sf.file_id WHERE sf.scene_id=? AND f.parent_folder_id=? LIMIT 1;"
+SQL_UPDATE_FILE = (
+    "UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;"
+)
+SQL_MARK_ORGANIZED = "UPDATE scenes SET organized=? WHERE id=?;"
+# every field used to build the nfo and the new path, requested along with the scenes
+# so they don't need to be hydrated with extra queries per scene
+SCENE_FRAGMENT = """
+id
+title
+details
+date
+rating100
+files {
+    path
+    width
+    height
+}
+paths {
+    screenshot
+}
+stash_ids {
+    stash_id
+}
+tags {
+    name
+}
+studio {
+    id
+    name
+    parent_studio {
+        id
+        name
+        parent_studio {
+            id
+            name
+            parent_studio {
+                id
+                name
+            }
+        }
+    }
+}
+performers {
+    id
+    name
+    gender
+    image_path
+}
+"""
 
 
 def process_all_scenes(stash, settings, cursor, api_key):
     count = stash.find_scenes(
         f=QUERY_WHERE_STASH_ID_NOT_NULL,
         filter={"per_page": 1},
+        fragment="id",
         get_count=True,
     )[0]
 
     log.debug(f"{str(count)} scenes to scan.")
+    num_pages = math.ceil(count / BATCH_SIZE)
 
-    for r in range(1, int(count / BATCH_SIZE) + 1):
-        start = r * BATCH_SIZE
-        end = start + BATCH_SIZE
-        if end > count:
-            end = count
-
-        log.debug(f"Processing {str(start)}-{str(end)}")
-
-        scenes = stash.find_scenes(
+    pages = prefetch_pages(
+        lambda page: stash.find_scenes(
             f=QUERY_WHERE_STASH_ID_NOT_NULL,
-            filter={"page": r, "per_page": BATCH_SIZE},
-        )
-
-        for scene in scenes:
-            process_scene(scene, stash, settings, cursor, api_key)
-
+            filter={"page": page, "per_page": BATCH_SIZE},
+            fragment=SCENE_FRAGMENT,
+        ),
+        range(1, num_pages + 1),
+    )
 
-def process_scene(scene, stash, settings, cursor, api_key):
+    # values read from settings.ini are strings
+    scene_workers = int(settings.get("scene_parallelism") or SCENE_WORKERS)
+
+    processed = 0
+    for r, scenes in pages:
+        log.debug(f"Processing page {r}/{num_pages}")
+
+        with ThreadPoolExecutor(max_workers=scene_workers) as executor:
+            # list every video directory of the page in parallel up front, so scenes sharing
+            # one find it cached instead of queueing on the lock of its first listing
+            video_dirs = {
+                os.path.dirname(scene["files"][0]["path"])
+                for scene in scenes
+                if scene["files"]
+            }
+            for _ in executor.map(dir_exists, video_dirs):
+                pass
+
+            futures = [
+                executor.submit(process_scene, scene, settings, api_key)
+                for scene in scenes
+            ]
+            # process_scene logs its own errors, the futures are only drained for progress
+            for _ in as_completed(futures):
+                processed += 1
+                log.progress(processed / count)
+
+        flush_db_updates(settings, cursor)
+        # the next page mostly lives in other directories, and listings shouldn't go stale
+        clear_dir_cache()
+        log.info(f"Processed {processed}/{count} scenes")
+
+
+def process_scene(scene, settings, api_key):
     try:
         log.debug(f"Processing Scene ID: {scene['id']}")
 
-        scene = __hydrate_scene(scene, stash)
+        scene = __sort_performers(scene)
         # rename/move primary video file if settings configured for that
-        # if not, function will just return the current path and we'll proceed with that
-        target_video_path = __rename_video(scene, settings, cursor)
+        if settings["enable_renamer"] is True:
+            target_video_path = __rename_video(scene, settings)
+        else:
+            log.debug("Skipping renaming because it's disabled in settings")
+            target_video_path = scene["files"][0]["path"]
+
+        # the nfo and poster are named after the video file, split its extension off once
+        target_base_path = os.path.splitext(target_video_path)[0]
 
         # overwrite nfo named after file, at file location (use renamed path if applicable)
-        nfo_path = replace_file_ext(target_video_path, "nfo")
+        nfo_path = f"{target_base_path}.nfo"
         __write_nfo(scene, nfo_path, settings)
 
+        # the performer images and the poster are separate downloads, overlap them
+        image_jobs = []
         # copy any performer images to people directory
-
-        for performer in scene["performers"] or []:
-            try:
-                process_performer(performer, settings, api_key)
-            except Exception as err:
-                log.error(f"Error processing performer image: {str(err)}")
+        if settings["enable_actor_images"] is True:
+            image_jobs = [
+                __image_executor.submit(process_performer, performer, settings, api_key)
+                for performer in scene["performers"] or []
+            ]
 
         # download any missing artwork images from stash into path
-        poster_path = replace_file_ext(target_video_path, "jpg", "-poster")
-        if not os.path.exists(poster_path):
-            screenshot_url = f"{scene['paths']['screenshot']}&apikey={api_key}"
-            download_image(screenshot_url, poster_path, settings)
+        poster_path = f"{target_base_path}-poster.jpg"
+        if not file_exists(poster_path):
+            image_jobs.append(
+                __image_executor.submit(
+                    download_image,
+                    scene["paths"]["screenshot"],
+                    poster_path,
+                    settings,
+                    api_key,
+                )
+            )
+
+        # process_performer logs its own errors, a failed poster is reported like any
+        # other error of the scene
+        for job in image_jobs:
+            job.result()
     except Exception as err:
         log.error(f"Error processing Scene ID {scene['id']}: {str(err)}")
 
 
-def __hydrate_scene(scene, stash):
-    fragmented_performers = scene["performers"] or []
-    performers = []
-    for fragmented_performer in fragmented_performers:
-        performer = stash.find_performer(
-            fragmented_performer["id"], False, "id name gender image_path"
-        )
-        performers.append(performer)
+def __sort_performers(scene):
+    # performers are nested in the scene query, which can't sort them, so order them here.
+    # a tuple key compares the same as "gender_name" without building a string per performer
     scene["performers"] = sorted(
-        performers,
-        key=lambda performer: f"{str(performer.get('gender', 'UNKNOWN'))}_{performer['name']}",
+        scene["performers"] or [],
+        key=lambda performer: (
+            str(performer.get("gender", "UNKNOWN")),
+            performer["name"],
+        ),
     )
-
-    if scene["studio"]:
-        scene["studio"] = stash.find_studio(
-            scene["studio"]["id"], "id name parent_studio { ...Studio }"
-        )
-
     return scene
 
 
-def __rename_video(scene, settings, cursor):
+def __rename_video(scene, settings):
     # get primary video file path
     video_path = scene["files"][0]["path"]
 
-    if settings["enable_renamer"] is not True:
-        log.debug("Skipping renaming because it's disabled in settings")
-        return video_path
+    renamer_path = settings.get("renamer_path", IMPOSSIBLE_PATH)
+    renamer_ignore_in_path = settings.get("renamer_ignore_files_in_path", False)
+    # values read from settings.ini are strings
+    renamer_filename_budget = int(settings.get("renamer_filename_budget") or 250)
 
     expected_path = get_new_path(
         scene,
-        settings["renamer_path"],
+        renamer_path,
         settings["renamer_path_template"],
-        settings.get("renamer_filepath_budget", 250),
+        renamer_filename_budget,
     )
 
     if expected_path is False:
         return video_path
 
     # check if we should rename it
-    renamer_path = settings.get("renamer_path", IMPOSSIBLE_PATH)
-    renamer_ignore_in_path = settings.get("renamer_ignore_files_in_path", False)
     in_target_dir = video_path.startswith(renamer_path)
 
     do_ignore = False
@@ -125,127 +244,158 @@ def __rename_video(scene, settings, cursor):
         log.debug("Skipping renaming because file is already organized")
         return video_path
 
-    if os.path.exists(expected_path):
-        log.info(f"Duplicate video. Expected path: {expected_path}")
-        return video_path
+    # the listing cache may be stale, collisions are always checked on disk. the metadata files
+    # are named after the video, so a base path being moved to by another worker is taken too
+    renamed_base_path = os.path.splitext(expected_path)[0]
+    with __rename_lock:
+        if renamed_base_path in __renames_in_progress or os.path.lexists(expected_path):
+            log.info(f"Duplicate video. Expected path: {expected_path}")
+            return video_path
+        __renames_in_progress.add(renamed_base_path)
+
+    try:
+        return __move_video(scene, video_path, expected_path, settings)
+    finally:
+        with __rename_lock:
+            __renames_in_progress.discard(renamed_base_path)
+
 
+def __move_video(scene, video_path, expected_path, settings):
     # rename/move video file. Will return False if it errors
     video_renamed_path = rename_file(video_path, expected_path, settings)
     if not video_renamed_path:
         return video_path
 
-    # update database with new file location
-    try:
-        __db_rename(scene["id"], video_path, video_renamed_path, settings, cursor)
-    except Exception as err:
-        log.error(
-            f"Error updating database for Scene ID {scene['id']}. You can likely resolve this by running a scan on your library: {str(err)}"
-        )
+    # update database with new file location once the page is done
+    __pending_renames.append((scene["id"], video_path, video_renamed_path))
 
     # locate any existing metadata files, rename them as well
-    potential_nfo_path = replace_file_ext(video_path, "nfo")
-    if os.path.exists(potential_nfo_path):
+    base_path = os.path.splitext(video_path)[0]
+    renamed_base_path = os.path.splitext(video_renamed_path)[0]
+    potential_nfo_path = f"{base_path}.nfo"
+    if os.path.isfile(potential_nfo_path):
         log.debug(f"Relocating existing NFO file: {potential_nfo_path}")
-        rename_file(
-            potential_nfo_path, replace_file_ext(video_renamed_path, "nfo"), settings
-        )
+        rename_file(potential_nfo_path, f"{renamed_base_path}.nfo", settings)
 
-    potential_poster_path = replace_file_ext(video_path, "jpg", "-poster")
-    if os.path.exists(potential_poster_path):
+    potential_poster_path = f"{base_path}-poster.jpg"
+    if os.path.isfile(potential_poster_path):
         log.debug(f"Relocating existing Poster image: {potential_poster_path}")
-        rename_file(
-            potential_poster_path,
-            replace_file_ext(video_renamed_path, "jpg", "-poster"),
-            settings,
-        )
+        rename_file(potential_poster_path, f"{renamed_base_path}-poster.jpg", settings)
 
     return video_renamed_path
 
 
+def flush_db_updates(settings, cursor):
+    if not __pending_renames:
+        return
+
+    log.debug(f"Updating database for {len(__pending_renames)} renamed files")
+    # apply every rename of the page as a single transaction
+    connection = cursor.connection
+    try:
+        # take the write lock up front, new folders are inserted while resolving the renames
+        if not connection.in_transaction:
+            cursor.execute("BEGIN IMMEDIATE")
+        for scene_id, old_filepath, new_filepath in __pending_renames:
+            try:
+                __db_rename(scene_id, old_filepath, new_filepath, settings, cursor)
+            except Exception as err:
+                log.error(
+                    f"Error updating database for Scene ID {scene_id}. You can likely resolve this by running a scan on your library: {str(err)}"
+                )
+        cursor.executemany(SQL_UPDATE_FILE, __pending_files)
+        cursor.executemany(SQL_MARK_ORGANIZED, __pending_organized)
+        if settings["dry_run"] is False:
+            connection.commit()
+            log.debug("Database updated")
+        else:
+            connection.rollback()
+            # nothing was kept, so neither were the folders inserted above
+            __folder_ids.clear()
+    except Exception as err:
+        connection.rollback()
+        # the folder cache may hold rows that were just rolled back
+        __folder_ids.clear()
+        log.error(
+            f"Error updating database. You can likely resolve this by running a scan on your library: {str(err)}"
+        )
+    finally:
+        __pending_renames.clear()
+        __pending_files.clear()
+        __pending_organized.clear()
+
+
 def __db_rename(scene_id, old_filepath, new_filepath, settings, cursor):
-    log.debug(f"Updating database for Scene ID {scene_id}")
     old_dir = os.path.dirname(old_filepath)
     new_dir = os.path.dirname(new_filepath)
     new_filename = os.path.basename(new_filepath)
     # 2022-09-17T11:25:52+02:00
     mod_time = datetime.now().astimezone().isoformat("T", "seconds")
 
-    # get the next id that we should use if needed
-    cursor.execute("SELECT MAX(id) from folders")
-    new_id = cursor.fetchall()[0][0] + 1
+    # the new folder and every one of its ancestors, deepest first
+    new_dir_ancestors = [new_dir]
+    while os.path.dirname(new_dir_ancestors[-1]) != new_dir_ancestors[-1]:
+        new_dir_ancestors.append(os.path.dirname(new_dir_ancestors[-1]))
+    folder_ids = __get_folder_ids([old_dir] + new_dir_ancestors, cursor)
 
     # get the old folder id
-    cursor.execute("SELECT id FROM folders WHERE path=?", [old_dir])
-    old_folder_id = cursor.fetchall()[0][0]
+    old_folder_id = folder_ids.get(old_dir)
+    if old_folder_id is None:
+        raise Exception(f"Failed to find folder {old_dir}")
+
+    # a scene can have multiple files, find the one in the old folder
+    cursor.execute(SQL_SELECT_SCENE_FILE_IN_FOLDER, [scene_id, old_folder_id])
+    file_id = cursor.fetchone()
+    if not file_id:
+        raise Exception("Failed to find file_id")
 
     # check if the folder of file is created in db
-    cursor.execute("SELECT id FROM folders WHERE path=?", [new_dir])
-    folder_id = cursor.fetchall()
-    if not folder_id:
-        dir = new_dir
-        # reduce the path to find a parent folder
-        for _ in range(1, len(new_dir.split(os.sep))):
-            dir = os.path.dirname(dir)
-            cursor.execute("SELECT id FROM folders WHERE path=?", [dir])
-            parent_id = cursor.fetchall()
-            if parent_id:
-                # create a new row with the new folder with the parent folder find above
-                cursor.execute(
-                    "INSERT INTO 'main'.'folders'('id', 'path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?, ?);",
-                    [
-                        new_id,
-                        new_dir,
-                        parent_id[0][0],
-                        mod_time,
-                        mod_time,
-                        mod_time,
-                        None,
-                    ],
-                )
-                folder_id = new_id
-                break
-    else:
-        folder_id = folder_id[0][0]
-    if folder_id:
-        cursor.execute(
-            "SELECT file_id from scenes_files WHERE scene_id=?",
-            [scene_id],
-        )
-        file_ids = cursor.fetchall()
-        file_id = None
-        for f in file_ids:
-            # it can have multiple file for a scene
-            cursor.execute("SELECT parent_folder_id from files WHERE id=?", [f[0]])
-            check_parent = cursor.fetchall()[0][0]
-            # if the parent id is the one found above section, we find our file.s
-            if check_parent == old_folder_id:
-                file_id = f[0]
+    folder_id = folder_ids.get(new_dir)
+    if folder_id is None:
+        # find the closest parent folder
+        for depth, dir in enumerate(new_dir_ancestors[1:], start=1):
+            folder_id = folder_ids.get(dir)
+            if folder_id is not None:
                 break
-        if file_id:
-            cursor.execute(
-                "UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;",
-                [new_filename, folder_id, mod_time, file_id],
-            )
-            if settings["renamer_enable_mark_organized"]:
+        if folder_id is not None:
+            # create a row for every missing folder below it, from the top down
+            for dir in reversed(new_dir_ancestors[:depth]):
                 cursor.execute(
-                    "UPDATE scenes SET organized=? WHERE id=?;", [True, scene_id]
+                    SQL_INSERT_FOLDER,
+                    [dir, folder_id, mod_time, mod_time, mod_time, None],
                 )
-        else:
-            raise Exception("Failed to find file_id")
-    else:
+                folder_id = cursor.lastrowid
+                __folder_ids[dir] = folder_id
+    if not folder_id:
         raise Exception(
             f"You need to setup a library with the new location ({new_dir}) and scan at least 1 file"
         )
-    log.debug("Database updated")
+
+    __pending_files.append((new_filename, folder_id, mod_time, file_id[0]))
+    if settings["renamer_enable_mark_organized"]:
+        __pending_organized.append((True, scene_id))
+    log.debug(f"Queued database update for Scene ID {scene_id}")
+
+
+def __get_folder_ids(paths, cursor):
+    # look up every path that isn't cached yet with a single query
+    missing = [path for path in paths if path not in __folder_ids]
+    if missing:
+        cursor.execute(
+            SQL_SELECT_FOLDERS_BY_PATH.format(", ".join("?" * len(missing))), missing
+        )
+        for id, path in cursor:
+            __folder_ids[path] = id
+    return {path: __folder_ids[path] for path in paths if path in __folder_ids}
 
 
 def __write_nfo(scene, filepath, settings):
     try:
         nfo_xml = build_nfo_xml(scene)
         if settings["dry_run"] is False:
-            f = open(filepath, "w", encoding="utf-8-sig")
-            f.write(nfo_xml)
-            f.close()
-            log.info(f"Updated NFO file: {filepath}")
+            if write_file_if_changed(filepath, nfo_xml.encode("utf-8-sig")):
+                log.info(f"Updated NFO file: {filepath}")
+            else:
+                log.debug(f"NFO file unchanged: {filepath}")
     except Exception as err:
         log.error(f"Error writing NFO: {str(err)}")
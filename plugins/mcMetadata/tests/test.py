@@ -1,9 +1,30 @@
+from itertools import count
 import os
+import stat
+import tempfile
 import unittest
-from utils.files import rename_file, replace_file_ext
+from utils.files import (
+    add_to_dir_cache,
+    clear_dir_cache,
+    dir_exists,
+    ensure_dir,
+    file_exists,
+    remove_from_dir_cache,
+    rename_file,
+    replace_file_ext,
+    write_file_if_changed,
+)
 from utils.nfo import build_nfo_xml
+from utils.pages import prefetch_pages
 from utils.replacer import get_new_path
-from utils.settings import validate_media_server, validate_settings
+from utils.settings import (
+    parse_settings,
+    replace_setting,
+    validate_download_concurrency,
+    validate_media_server,
+    validate_scene_parallelism,
+    validate_settings,
+)
 
 SEP = os.path.sep
 
@@ -79,6 +100,119 @@ class TestFiles(unittest.TestCase):
         )
         self.assertEqual(result, False, "Rename should return False when it fails")
 
+    def test_rename_existing_destination(self):
+        with tempfile.TemporaryDirectory() as dir:
+            video_path = os.path.join(dir, "video.mp4")
+            dest_path = os.path.join(dir, "renamed.mp4")
+            for path in (video_path, dest_path):
+                with open(path, "w") as f:
+                    f.write(path)
+
+            result = rename_file(video_path, dest_path, {"dry_run": False})
+            self.assertEqual(result, False, "Rename should refuse to overwrite a file")
+            with open(dest_path) as f:
+                self.assertEqual(f.read(), dest_path, "Destination should be untouched")
+            self.assertTrue(os.path.exists(video_path), "Source should be untouched")
+
+    def test_file_exists(self):
+        with tempfile.TemporaryDirectory() as dir:
+            video_path = os.path.join(dir, "someFile.mp4")
+            nfo_path = os.path.join(dir, "someFile.nfo")
+            open(video_path, "w").close()
+
+            self.assertTrue(dir_exists(dir), "Directory should exist")
+            self.assertTrue(file_exists(video_path), "Video file should exist")
+            self.assertFalse(file_exists(nfo_path), "NFO file should not exist")
+
+            add_to_dir_cache(nfo_path)
+            self.assertTrue(file_exists(nfo_path), "Added file should be cached")
+            remove_from_dir_cache(video_path)
+            self.assertFalse(file_exists(video_path), "Removed file should be cached")
+
+            clear_dir_cache()
+            self.assertTrue(file_exists(video_path), "Cleared cache should list again")
+            self.assertFalse(file_exists(nfo_path), "Cleared cache should list again")
+
+    def test_ensure_dir(self):
+        with tempfile.TemporaryDirectory() as dir:
+            new_dir = os.path.join(dir, "K", "Some Performer")
+            self.assertFalse(dir_exists(new_dir), "Directory should not exist yet")
+            self.assertFalse(file_exists(new_dir), "Parent should not list it yet")
+
+            ensure_dir(new_dir)
+            self.assertTrue(os.path.isdir(new_dir), "Directory should be created")
+            self.assertTrue(dir_exists(new_dir), "Created directory should be cached")
+            self.assertTrue(
+                file_exists(new_dir), "Created directory should be added to its parent"
+            )
+            ensure_dir(new_dir)
+
+    def test_ensure_dir_stale_listing(self):
+        with tempfile.TemporaryDirectory() as dir:
+            new_dir = os.path.join(dir, "K")
+            video_path = os.path.join(new_dir, "video.mp4")
+            self.assertFalse(dir_exists(new_dir), "Directory should not exist yet")
+
+            # created by something else after it was listed as missing
+            os.mkdir(new_dir)
+            with open(video_path, "w") as f:
+                f.write("")
+            ensure_dir(new_dir)
+            self.assertTrue(
+                file_exists(video_path), "Files in the directory should be listed"
+            )
+
+    def test_file_exists_missing_dir(self):
+        self.assertFalse(
+            dir_exists(f"{MOCK_BASE_PATH}missing"), "Directory should not exist"
+        )
+        self.assertFalse(
+            file_exists(f"{MOCK_BASE_PATH}missing{SEP}someFile.mp4"),
+            "File in a missing directory should not exist",
+        )
+
+    def test_write_file_if_changed(self):
+        with tempfile.TemporaryDirectory() as dir:
+            nfo_path = os.path.join(dir, "someFile.nfo")
+
+            self.assertTrue(write_file_if_changed(nfo_path, b"<movie />"))
+            self.assertFalse(
+                write_file_if_changed(nfo_path, b"<movie />"),
+                "Identical content should not be rewritten",
+            )
+            self.assertTrue(write_file_if_changed(nfo_path, b"<movie>1</movie>"))
+            with open(nfo_path, "rb") as f:
+                self.assertEqual(f.read(), b"<movie>1</movie>")
+            self.assertEqual(os.listdir(dir), ["someFile.nfo"])
+
+    def test_write_file_if_changed_keeps_mode(self):
+        with tempfile.TemporaryDirectory() as dir:
+            nfo_path = os.path.join(dir, "video.nfo")
+            with open(nfo_path, "wb") as f:
+                f.write(b"old")
+            os.chmod(nfo_path, 0o600)
+
+            self.assertTrue(
+                write_file_if_changed(nfo_path, b"new"), "NFO should change"
+            )
+            self.assertEqual(
+                stat.S_IMODE(os.stat(nfo_path).st_mode),
+                0o600,
+                "Rewritten file should keep its mode",
+            )
+
+    def test_write_file_if_changed_fail(self):
+        with tempfile.TemporaryDirectory() as dir:
+            # a directory can't be replaced by a file
+            target_path = os.path.join(dir, "video.nfo")
+            os.mkdir(target_path)
+
+            with self.assertRaises(OSError):
+                write_file_if_changed(target_path, b"new")
+            self.assertFalse(
+                os.path.exists(f"{target_path}.tmp"), "Temporary file should be removed"
+            )
+
     def test_replace_file_ext(self):
         self.assertEqual(
             replace_file_ext(MOCK_SCENE["files"][0]["path"], "jpg"),
@@ -171,6 +305,23 @@ class TestNFO(unittest.TestCase):
             "The generated XML is wrong",
         )
 
+    def test_escaped(self):
+        mock_scene = MOCK_SCENE.copy()
+        mock_scene["details"] = "Contains ]]> inside"
+        mock_scene["performers"] = [{"gender": "FEMALE", "name": "Jane <Doe>"}]
+        mock_scene["studio"] = {"name": "Brazzers & Co"}
+        mock_scene["tags"] = [{"name": "Tom & Jerry"}]
+        mock_scene["title"] = "Q&A <Live>"
+        result = build_nfo_xml(mock_scene)
+
+        self.assertIn("<title>Q&amp;A &lt;Live&gt;</title>", result)
+        self.assertIn("<studio>Brazzers &amp; Co</studio>", result)
+        self.assertIn("<name>Jane &lt;Doe&gt;</name>", result)
+        self.assertIn("<tag>Tom &amp; Jerry</tag>", result)
+        self.assertIn(
+            "<plot><![CDATA[Contains ]]]]><![CDATA[> inside]]></plot>", result
+        )
+
     def test_missing_field_in_scene(self):
         mock_scene = MOCK_SCENE.copy()
         mock_scene.pop("id")
@@ -179,6 +330,35 @@ class TestNFO(unittest.TestCase):
             build_nfo_xml(mock_scene)
 
 
+class TestPages(unittest.TestCase):
+    def test_prefetch_pages(self):
+        result = list(prefetch_pages(lambda page: [page * 10], range(1, 4)))
+        self.assertEqual(
+            result,
+            [(1, [10]), (2, [20]), (3, [30])],
+            "Pages should be returned in order with their results",
+        )
+
+    def test_prefetch_until_short_page(self):
+        fetched = []
+
+        def fetch_page(page):
+            fetched.append(page)
+            return [page] * (2 if page < 3 else 1)
+
+        result = list(prefetch_pages(fetch_page, count(1), 2))
+        self.assertEqual(
+            result,
+            [(1, [1, 1]), (2, [2, 2]), (3, [3])],
+            "Pages should stop after the first short page",
+        )
+        self.assertEqual(fetched, [1, 2, 3], "No page after the short one is fetched")
+
+    def test_prefetch_no_pages(self):
+        result = list(prefetch_pages(lambda page: [page], []))
+        self.assertEqual(result, [], "No pages should be fetched")
+
+
 class TestReplacers(unittest.TestCase):
     def test_all(self):
         template = f"$Studios{SEP}$Studio - $StashID - $Title ($ReleaseYear) - $FemalePerformers $MalePerformers $Performers $ReleaseDate [$Quality-$Resolution] $Tags"
@@ -198,6 +378,17 @@ class TestReplacers(unittest.TestCase):
             "The path is wrong",
         )
 
+    def test_empty_groups_trimmed(self):
+        template = "$Title ([$Tags]) [$Tags] -- $ReleaseYear"
+        mock_scene = MOCK_SCENE.copy()
+        mock_scene["tags"] = []
+        result = get_new_path(mock_scene, MOCK_BASE_PATH, template, 500)
+        self.assertEqual(
+            result,
+            f"{MOCK_BASE_PATH}Episode Title - 2022.mp4",
+            "Empty groups and repeated separators should be removed",
+        )
+
     def test_cannot_truncate(self):
         template = f"$Studios{SEP}$Studio - $StashID - $Title ($ReleaseYear) - $FemalePerformers $MalePerformers $Performers $ReleaseDate [$Quality-$Resolution] $Tags"
         mock_scene = MOCK_SCENE.copy()
@@ -410,6 +601,62 @@ class TestReplacers(unittest.TestCase):
 
 
 class TestSettings(unittest.TestCase):
+    def test_parse_settings(self):
+        text = "# comment\n[other]\ndry_run = false\n\n[settings]\n; comment\nDry_Run = Yes\nenable_hook=off\nrenamer_path_template = $Title = $StashID\nenable_renamer = maybe\n"
+        self.assertEqual(
+            parse_settings(text),
+            {
+                "dry_run": True,
+                "enable_hook": False,
+                "renamer_path_template": "$Title = $StashID",
+                "enable_renamer": "maybe",
+            },
+            "Only the settings section should be parsed, with booleans coerced",
+        )
+
+    def test_parse_settings_configparser_syntax(self):
+        text = "[settings]\ndry_run: true\nrenamer_path = C:\\data\\\nrenamer_path_template = 100%% $StashID\n"
+        self.assertEqual(
+            parse_settings(text),
+            {
+                "dry_run": True,
+                "renamer_path": "C:\\data\\",
+                "renamer_path_template": "100% $StashID",
+            },
+            "Colon delimiters and escaped percent signs should be read like configparser",
+        )
+
+    def test_replace_setting(self):
+        text = "# comment\n[settings]\ndry_run = true\nenable_hook=true\n"
+        self.assertEqual(
+            replace_setting(text, "enable_hook", "false"),
+            "# comment\n[settings]\ndry_run = true\nenable_hook = false\n",
+            "Only the line of the updated setting should change",
+        )
+        self.assertEqual(
+            replace_setting(text, "enable_renamer", "true"),
+            f"{text}enable_renamer = true\n",
+            "A missing setting should be appended",
+        )
+        self.assertEqual(
+            replace_setting("[settings]\ndry_run: true\n", "dry_run", "false"),
+            "[settings]\ndry_run = false\n",
+            "A setting written with a colon should be replaced too",
+        )
+
+    def test_replace_setting_sections(self):
+        text = "[other]\nenable_hook = maybe\n\n[settings]\ndry_run = true\n\n[more]\nkey = value\n"
+        self.assertEqual(
+            replace_setting(text, "enable_hook", "false"),
+            "[other]\nenable_hook = maybe\n\n[settings]\ndry_run = true\nenable_hook = false\n\n[more]\nkey = value\n",
+            "A missing setting should be added to the end of the settings section",
+        )
+        self.assertEqual(
+            replace_setting("[other]\nkey = value\n", "dry_run", "true"),
+            "[other]\nkey = value\n[settings]\ndry_run = true\n",
+            "A missing settings section should be added",
+        )
+
     def test_valid_config(self):
         self.assertEqual(
             validate_settings(MOCK_SETTINGS),
@@ -426,6 +673,22 @@ class TestSettings(unittest.TestCase):
             "Validate should return False with an invalid boolean",
         )
 
+    def test_download_concurrency(self):
+        mock_settings = MOCK_SETTINGS.copy()
+        mock_settings["download_concurrency"] = "8"
+        validate_download_concurrency(mock_settings)
+        mock_settings["download_concurrency"] = "0"
+        with self.assertRaises(ValueError):
+            validate_download_concurrency(mock_settings)
+
+    def test_scene_parallelism(self):
+        mock_settings = MOCK_SETTINGS.copy()
+        mock_settings["scene_parallelism"] = "12"
+        validate_scene_parallelism(mock_settings)
+        mock_settings["scene_parallelism"] = "65"
+        with self.assertRaises(ValueError):
+            validate_scene_parallelism(mock_settings)
+
     def test_invalid_filename_budget(self):
         mock_settings = MOCK_SETTINGS.copy()
         mock_settings["renamer_filename_budget"] = 39
@@ -442,6 +705,16 @@ class TestSettings(unittest.TestCase):
         with self.assertRaises(ValueError):
             validate_media_server(mock_settings)
 
+    def test_disabled_renamer_not_validated(self):
+        mock_settings = MOCK_SETTINGS.copy()
+        mock_settings["enable_renamer"] = False
+        mock_settings["renamer_path_template"] = "$StashID - $Title <$Performers>"
+        self.assertEqual(
+            validate_settings(mock_settings),
+            True,
+            "Renamer settings should not be validated while the renamer is disabled",
+        )
+
     def test_invalid_template(self):
         mock_settings = MOCK_SETTINGS.copy()
         mock_settings["renamer_path_template"] = "$StashID - $Title <$Performers>"
@@ -460,6 +733,15 @@ class TestSettings(unittest.TestCase):
             "Validate should return False with an invalid renamer_path_template",
         )
 
+    def test_invalid_uniqueness_partial_variable(self):
+        mock_settings = MOCK_SETTINGS.copy()
+        mock_settings["renamer_path_template"] = "$Title $StashIDs"
+        self.assertEqual(
+            validate_settings(mock_settings),
+            False,
+            "Validate should return False when a unique variable only appears inside another word",
+        )
+
     def test_missing_required_setting(self):
         mock_settings = MOCK_SETTINGS.copy()
         mock_settings.pop("dry_run")
@@ -1,32 +1,235 @@
+from email.utils import formatdate
+import errno
 import os
-import urllib.request
+import shutil
+import stat
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import stashapi.log as log
 
+# default max number of images downloaded at the same time, one pooled connection each
+DOWNLOAD_WORKERS = 16
 
-def download_image(url, dest_filepath, settings):  # pragma: no cover
+# one session for every image download so connections to Stash are kept alive and reused
+__http = requests.Session()
+
+
+def set_download_workers(workers):
+    # keep one pooled connection per worker so none of them are opened just to be discarded
+    adapter = HTTPAdapter(
+        # every request goes to the same Stash server, so one pool is enough
+        pool_connections=1,
+        pool_maxsize=workers,
+        max_retries=Retry(total=3, backoff_factor=0.2),
+    )
+    __http.mount("http://", adapter)
+    __http.mount("https://", adapter)
+
+
+set_download_workers(DOWNLOAD_WORKERS)
+
+# O_BINARY only exists (and matters) on Windows
+WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+# directory -> set of entry names, or None when the directory doesn't exist.
+# lets sibling files (nfo, poster, performer images) share a single scandir instead of a stat
+# each. only for existence checks, anything that moves or overwrites files asks the disk
+__dir_listings = {}
+# directory -> lock held while that directory is scanned or its listing updated, so a scan never
+# interleaves with an update. other directories are scanned in parallel, which matters on slow
+# network shares
+__dir_locks = {}
+# only guards __dir_locks itself, never held during disk access
+__dir_locks_lock = threading.Lock()
+
+
+def __get_dir_lock(dir):
+    with __dir_locks_lock:
+        lock = __dir_locks.get(dir)
+        if lock is None:
+            lock = __dir_locks[dir] = threading.Lock()
+        return lock
+
+
+def __get_dir_listing(dir):
+    # callers hold the lock of dir
+    if dir not in __dir_listings:
+        try:
+            __dir_listings[dir] = {entry.name for entry in os.scandir(dir)}
+        except OSError:
+            __dir_listings[dir] = None
+    return __dir_listings[dir]
+
+
+def __add_to_dir_listing(dir, name):
+    # callers hold the lock of dir
+    listing = __get_dir_listing(dir)
+    if listing is None:
+        __dir_listings[dir] = {name}
+    else:
+        listing.add(name)
+
+
+def clear_dir_cache():
+    # bulk runs can span thousands of directories, drop listings once they're no longer needed
+    with __dir_locks_lock:
+        __dir_listings.clear()
+        __dir_locks.clear()
+
+
+def add_to_dir_cache(filepath):
+    dir, filename = os.path.split(filepath)
+    with __get_dir_lock(dir):
+        __add_to_dir_listing(dir, filename)
+
+
+def remove_from_dir_cache(filepath):
+    dir, filename = os.path.split(filepath)
+    with __get_dir_lock(dir):
+        listing = __dir_listings.get(dir)
+        if listing is not None:
+            listing.discard(filename)
+
+
+def dir_exists(dir):
+    with __get_dir_lock(dir):
+        return __get_dir_listing(dir) is not None
+
+
+def ensure_dir(dir):
+    # the listing cache already knows about most directories, so only touch the disk when needed
+    with __get_dir_lock(dir):
+        if __get_dir_listing(dir) is not None:
+            return
+        os.makedirs(dir, exist_ok=True)
+        # it may have existed after all (created since it was listed), so scan it again when needed
+        __dir_listings.pop(dir, None)
+    # a parent that was already listed must now include the new directory
+    parent, name = os.path.split(dir)
+    with __get_dir_lock(parent):
+        if parent in __dir_listings:
+            __add_to_dir_listing(parent, name)
+
+
+def file_exists(filepath):
+    dir, filename = os.path.split(filepath)
+    with __get_dir_lock(dir):
+        listing = __get_dir_listing(dir)
+        return listing is not None and filename in listing
+
+
+def download_image(url, dest_filepath, settings, api_key=None):  # pragma: no cover
     if settings["dry_run"] is False:
-        urllib.request.urlretrieve(url, dest_filepath)
+        # send the api key as a header so it doesn't end up in urls and logs
+        headers = {"ApiKey": api_key} if api_key else {}
+        # only have Stash send the image again if it changed since we saved it
+        if file_exists(dest_filepath):
+            headers["If-Modified-Since"] = formatdate(
+                os.path.getmtime(dest_filepath), usegmt=True
+            )
+        with __http.get(url, headers=headers, stream=True, timeout=30) as response:
+            if response.status_code == 304:
+                log.debug(f"Image {dest_filepath} is up to date")
+                return
+            response.raise_for_status()
+            # a dropped connection must not leave a truncated image that looks up to date
+            tmp_filepath = f"{dest_filepath}.tmp"
+            try:
+                with open(tmp_filepath, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        f.write(chunk)
+                os.replace(tmp_filepath, dest_filepath)
+            except BaseException:
+                try:
+                    os.unlink(tmp_filepath)
+                except OSError:
+                    pass
+                raise
+        add_to_dir_cache(dest_filepath)
         log.debug(f"Downloading image {url} to {dest_filepath}")
 
 
-def rename_file(filepath, dest_filepath, settings):
-    dir = os.path.dirname(dest_filepath)
+def write_file_if_changed(filepath, data):
+    # re-runs mostly produce identical files, leave those untouched
+    existing = None
+    if file_exists(filepath):
+        try:
+            existing = os.stat(filepath)
+            if existing.st_size == len(data):
+                with open(filepath, "rb") as f:
+                    if f.read() == data:
+                        return False
+        except OSError:
+            existing = None
+
+    # write to a temporary file first so a failed write never leaves a truncated file
+    tmp_filepath = f"{filepath}.tmp"
+    # the data is already encoded, so write it to the descriptor without a buffered file object
+    fd = os.open(tmp_filepath, WRITE_FLAGS, 0o644)
     try:
-        if not os.path.exists(dir) and settings["dry_run"] is False:
-            os.makedirs(dir)  # pragma: no cover
         try:
-            if settings["dry_run"] is False:
-                os.rename(filepath, dest_filepath)  # pragma: no cover
-                log.debug(f"Renamed {filepath} to {dest_filepath}")  # pragma: no cover
-            return dest_filepath
-        except Exception as err:  # pragma: no cover
-            log.error(f"Error renaming file {filepath} to {dest_filepath}: {str(err)}")
-            return False
-    except Exception as d_err:
-        log.error(f"Error creating directory {dir}: {str(d_err)}")
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+        if existing is not None:
+            # media server shares rely on the mode and owner of the file being replaced
+            os.chmod(tmp_filepath, stat.S_IMODE(existing.st_mode))
+            if hasattr(os, "chown"):
+                try:
+                    os.chown(tmp_filepath, existing.st_uid, existing.st_gid)
+                except OSError:
+                    pass
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        try:
+            os.unlink(tmp_filepath)
+        except OSError:
+            pass
+        raise
+    add_to_dir_cache(filepath)
+    return True
+
+
+def rename_file(filepath, dest_filepath, settings):
+    try:
+        if settings["dry_run"] is False:
+            ensure_dir(os.path.dirname(dest_filepath))  # pragma: no cover
+            __move_file(filepath, dest_filepath)  # pragma: no cover
+            remove_from_dir_cache(filepath)  # pragma: no cover
+            add_to_dir_cache(dest_filepath)  # pragma: no cover
+            log.debug(f"Renamed {filepath} to {dest_filepath}")  # pragma: no cover
+        return dest_filepath
+    except Exception as err:
+        log.error(f"Error renaming file {filepath} to {dest_filepath}: {str(err)}")
         return False
 
 
+def __move_file(filepath, dest_filepath):  # pragma: no cover
+    # os.rename overwrites silently outside of Windows, never move over an existing file
+    if os.path.lexists(dest_filepath):
+        raise FileExistsError(errno.EEXIST, "Destination already exists", dest_filepath)
+    try:
+        os.rename(filepath, dest_filepath)
+    except OSError as err:
+        # the renamer path can be on a different drive, that needs a copy instead
+        if err.errno != errno.EXDEV:
+            raise
+        try:
+            shutil.copy2(filepath, dest_filepath)
+            os.unlink(filepath)
+        except BaseException:
+            # a partial copy would be seen as a duplicate by every later run, and imported by Stash
+            try:
+                os.unlink(dest_filepath)
+            except OSError:
+                pass
+            raise
+
+
 def replace_file_ext(filepath, ext, suffix=""):
     path = os.path.splitext(filepath)
     return path[0] + suffix + "." + ext
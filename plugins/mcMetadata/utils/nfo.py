@@ -1,10 +1,8 @@
 import os
+from string import Formatter
+from xml.sax.saxutils import escape
 
-INDENTED_NEWLINE = "\n    "
-
-
-def build_nfo_xml(scene):
-    ret = """<?xml version="1.0" encoding="utf-8" standalone="yes"?>
+NFO_TEMPLATE = """<?xml version="1.0" encoding="utf-8" standalone="yes"?>
 <movie>
     <name>{title}</name>
     <title>{title}</title>
@@ -21,15 +19,30 @@ def build_nfo_xml(scene):
     <genre>Adult</genre>{tags}
     <uniqueid type="stash">{id}</uniqueid>
 </movie>"""
+ACTOR_TEMPLATE = """
+    <actor>
+        <name>{name}</name>
+        <role>{name}</role>
+        <order>{order}</order>
+        <type>Actor</type>
+    </actor>"""
+TAG_TEMPLATE = "\n    <tag>{name}</tag>"
+# split the template into (literal, field) pairs once instead of on every format() call
+NFO_TEMPLATE_PARTS = tuple(
+    (literal, field) for literal, field, _, _ in Formatter().parse(NFO_TEMPLATE)
+)
 
+
+def build_nfo_xml(scene):
     id = scene["id"]
-    details = scene["details"] or ""
+    # a CDATA section can't contain its own terminator, so split it around any occurrence
+    details = (scene["details"] or "").replace("]]>", "]]]]><![CDATA[>")
 
     title = ""
     if scene["title"] is not None and scene["title"] != "":
-        title = scene["title"]
+        title = escape(scene["title"])
     else:
-        title = os.path.basename(os.path.normpath(scene["files"][0]["path"]))
+        title = escape(os.path.basename(os.path.normpath(scene["files"][0]["path"])))
 
     custom_rating = ""
     rating = ""
@@ -45,38 +58,15 @@ def build_nfo_xml(scene):
 
     studio = ""
     if scene["studio"] is not None:
-        studio = scene["studio"]["name"]
-
-    performers = INDENTED_NEWLINE
-    i = 0
+        studio = escape(scene["studio"]["name"])
 
-    for p in scene["performers"]:
-        if i != 0:
-            performers = performers + INDENTED_NEWLINE
-        performers = (
-            performers
-            + """<actor>
-        <name>{}</name>
-        <role>{}</role>
-        <order>{}</order>
-        <type>Actor</type>
-    </actor>""".format(p["name"], p["name"], i)
-        )
-        i += 1
-    if performers == INDENTED_NEWLINE:
-        performers = ""
-
-    tags = INDENTED_NEWLINE
-    iTwo = 0
-    for t in scene["tags"]:
-        if iTwo != 0:
-            tags = tags + INDENTED_NEWLINE
-        tags = tags + """<tag>{}</tag>""".format(t["name"])
-        iTwo += 1
-    if tags == INDENTED_NEWLINE:
-        tags = ""
+    performers = "".join(
+        ACTOR_TEMPLATE.format(name=escape(p["name"]), order=i)
+        for i, p in enumerate(scene["performers"])
+    )
+    tags = "".join(TAG_TEMPLATE.format(name=escape(t["name"])) for t in scene["tags"])
 
-    return ret.format(
+    return __render_template(
         title=title,
         custom_rating=custom_rating,
         rating=rating,
@@ -88,3 +78,10 @@ def build_nfo_xml(scene):
         performers=performers,
         details=details,
     )
+
+
+def __render_template(**values):
+    return "".join(
+        literal if field is None else f"{literal}{values[field]}"
+        for literal, field in NFO_TEMPLATE_PARTS
+    )
@@ -0,0 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch_pages(fetch_page, pages, page_size=None):
+    # request the next page in the background while the caller processes the current one.
+    # with a page_size, a short page is the last one, so pages can be an endless count
+    pages = iter(pages)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = next(pages, None)
+        future = None if page is None else executor.submit(fetch_page, page)
+        while future is not None:
+            current_page, results = page, future.result()
+            if page_size is not None and len(results) < page_size:
+                page = None
+            else:
+                page = next(pages, None)
+            future = None if page is None else executor.submit(fetch_page, page)
+            yield current_page, results
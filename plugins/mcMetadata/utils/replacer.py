@@ -1,157 +1,130 @@
+from bisect import bisect_right
+from functools import lru_cache
 import os
 import re
 import stashapi.log as log
 
-
-def __replacer_female_performers(scene):
-    female_performers = []
-    for performer in scene["performers"]:
-        if performer["gender"] == "FEMALE":
-            performer_name = __replace_invalid_file_chars(performer["name"])
-            female_performers.append(performer_name)
-    return " ".join(female_performers)
-
-
-def __replacer_male_performers(scene):
-    male_performers = []
-    for performer in scene["performers"]:
-        if performer["gender"] == "MALE":
-            performer_name = __replace_invalid_file_chars(performer["name"])
-            male_performers.append(performer_name)
-    return " ".join(male_performers)
-
-
-def __replacer_performers(scene):
-    performers = []
+# characters that aren't allowed in filenames, & is expanded separately since it becomes a word
+INVALID_FILE_CHARS_TABLE = str.maketrans(
+    {char: " " for char in '<>\\/?*"|'} | {":": "-"}
+)
+# file heights where quality and resolution move up a step, with the labels for each range
+HEIGHT_THRESHOLDS = (480, 720, 1080, 1440, 2160, 4320)
+QUALITY_LABELS = ("LOW", "SD", "HD", "FHD", "QHD", "UHD", "FUHD")
+RESOLUTION_LABELS = (None, "480p", "720p", "1080p", "1440p", "4K", "8K")
+# empty brackets, and parens that are empty once their empty brackets are gone
+EMPTY_GROUPS_REGEX = re.compile(r"\[\]|\((?:\[\])*\)")
+# removing empty groups can leave runs behind, so these are collapsed in a second pass
+REPEATED_SEPARATORS_REGEX = re.compile(r"\s{2,}|-{2,}")
+
+
+def __get_performer_names(scene):
+    # sanitized and grouped once per scene, all performer replacers of a template share them
+    names = {"ALL": [], "FEMALE": [], "MALE": []}
     for performer in scene["performers"]:
         performer_name = __replace_invalid_file_chars(performer["name"])
-        performers.append(performer_name)
-    return " ".join(performers)
+        names["ALL"].append(performer_name)
+        if performer["gender"] in names:
+            names[performer["gender"]].append(performer_name)
+    return {key: " ".join(value) for key, value in names.items()}
 
 
-def __replacer_quality(scene):
-    height = scene["files"][0]["height"]
+def __replacer_female_performers(scene, performer_names):
+    return performer_names["FEMALE"]
 
-    if not height:
-        raise ValueError("No file height value")
 
-    if height < 480:
-        return "LOW"
+def __replacer_male_performers(scene, performer_names):
+    return performer_names["MALE"]
 
-    if height < 720:
-        return "SD"
 
-    if height < 1080:
-        return "HD"
+def __replacer_performers(scene, performer_names):
+    return performer_names["ALL"]
 
-    if height < 1440:
-        if scene["files"][0]["width"] < 2048:
-            return "FHD"
-        else:
-            return "2K"
 
-    if height < 2160:
-        return "QHD"
+def __replacer_quality(scene, performer_names):
+    file = scene["files"][0]
+    height = file["height"]
 
-    if height < 4320:
-        return "UHD"
+    if not height:
+        raise ValueError("No file height value")
 
-    return "FUHD"
+    quality = QUALITY_LABELS[bisect_right(HEIGHT_THRESHOLDS, height)]
+    # 1080p-1440p files are only 2K when they're wide enough
+    if quality == "FHD" and file["width"] >= 2048:
+        return "2K"
+    return quality
 
 
-def __replacer_release_date(scene):
-    if scene["date"]:
-        return scene["date"]
+def __replacer_release_date(scene, performer_names):
+    date = scene["date"]
+    if date:
+        return date
     else:
         raise ValueError("No date value")
 
 
-def __replacer_release_year(scene):
-    if scene["date"]:
-        return scene["date"].split("-")[0]
+def __replacer_release_year(scene, performer_names):
+    date = scene["date"]
+    if date:
+        return date.split("-")[0]
     else:
         raise ValueError("No date value")
 
 
-def __replacer_resolution(scene):
+def __replacer_resolution(scene, performer_names):
     height = scene["files"][0]["height"]
 
     if not height:
         raise ValueError("No file height value")
 
-    if height < 480:
-        return str(scene["files"][0]["height"]) + "p"
-
-    if height < 720:
-        return "480p"
-
-    if height < 1080:
-        return "720p"
+    if height < HEIGHT_THRESHOLDS[0]:
+        return f"{height}p"
 
-    if height < 1440:
-        return "1080p"
+    return RESOLUTION_LABELS[bisect_right(HEIGHT_THRESHOLDS, height)]
 
-    if height < 2160:
-        return "1440p"
 
-    if height < 4320:
-        return "4K"
-
-    return "8K"
-
-
-def __replacer_stash_id(scene):
-    if len(scene["stash_ids"]):
-        return scene["stash_ids"][0]["stash_id"]
+def __replacer_stash_id(scene, performer_names):
+    stash_ids = scene["stash_ids"]
+    if stash_ids:
+        return stash_ids[0]["stash_id"]
     else:
         raise ValueError("No stash_id value")
 
 
-def __replacer_studio(scene):
-    if scene["studio"]:
-        return __replace_invalid_file_chars(scene["studio"]["name"])
+def __replacer_studio(scene, performer_names):
+    studio = scene["studio"]
+    if studio:
+        return __replace_invalid_file_chars(studio["name"])
     else:
         raise ValueError("No studio value")
 
 
-def __replacer_studios(scene):
-    if scene["studio"]:
-        studios = []
-        i = 0
-
-        cur_node = scene["studio"]
-        while i == 0:
-            studios.append(__replace_invalid_file_chars(cur_node["name"]))
-            if not cur_node["parent_studio"]:
-                i = 1
-            else:
-                cur_node = cur_node["parent_studio"]
-        studios.reverse()
-
-        sep = os.path.sep
-        if sep == "\\":
-            sep = "\\\\"
-        result = sep.join(studios)
-        return result
-    else:
+def __replacer_studios(scene, performer_names):
+    studio = scene["studio"]
+    if not studio:
         raise ValueError("No studio value")
 
+    # walk up to the top level studio, it becomes the outermost directory
+    studios = []
+    while studio:
+        studios.append(__replace_invalid_file_chars(studio["name"]))
+        studio = studio.get("parent_studio")
+    return os.path.sep.join(reversed(studios))
 
-def __replacer_tags(scene):
-    tags = []
-    for tag in scene["tags"]:
-        tag_name = __replace_invalid_file_chars(tag["name"])
-        tags.append(tag_name)
-    return " ".join(tags)
 
+def __replacer_tags(scene, performer_names):
+    return " ".join(__replace_invalid_file_chars(tag["name"]) for tag in scene["tags"])
 
-def __replacer_title(scene):
-    if scene["title"]:
-        return __replace_invalid_file_chars(scene["title"])
+
+def __replacer_title(scene, performer_names):
+    title = scene["title"]
+    if title:
+        return __replace_invalid_file_chars(title)
     else:
         raise ValueError("No title value")
 
 
+# every replacer is called with the scene and the names from __get_performer_names
 truncable_replacers = {
     # order here matters. they are arranged in order of priority
     "$FemalePerformers": __replacer_female_performers,
@@ -174,8 +147,29 @@ replacers = {
 replacers.update(truncable_replacers)
 
 
-def __get_replacer_regex(key):
-    return r"\$" + key[1:] + r"(?=[^a-zA-Z]|$)"
+# (key, replacer, truncable) in priority order, so get_new_path doesn't look each one up
+REPLACER_ITEMS = tuple(
+    (key, replacer, key in truncable_replacers) for key, replacer in replacers.items()
+)
+# matches every replacer key in one pass. longest keys first so $Studios wins over $Studio.
+# the key is captured so split() keeps it between the literal parts of the template
+REPLACER_REGEX = re.compile(
+    r"(\$(?:"
+    + "|".join(sorted((key[1:] for key in replacers), key=len, reverse=True))
+    + r")(?![a-zA-Z]))"
+)
+
+
+# the template is the same for every scene of a run, so only work out its keys once
+@lru_cache(maxsize=32)
+def __compile_template(template):
+    # literal text at even indexes, replacer keys at odd ones
+    parts = tuple(REPLACER_REGEX.split(template))
+    template_keys = set(parts[1::2])
+    items = tuple(item for item in REPLACER_ITEMS if item[0] in template_keys)
+    # length of the template once its keys are replaced, not counting their values
+    literal_len = len(template) - sum(len(key) for key in template_keys)
+    return items, literal_len, parts
 
 
 def get_new_path(scene, basepath, template, budget):
@@ -193,40 +187,34 @@ def get_new_path(scene, basepath, template, budget):
             )
 
         replacer_values = {}
-        keys_len = 0
+        truncable_keys = []
         values_len = 0
-
-        for key in replacers.keys():
-            if re.search(__get_replacer_regex(key), template) is not None:
-                value = replacers[key](scene)
-                replacer_values[key] = value
-                keys_len += len(key)
-                values_len += len(value)
-
         truncable_len = 0
-        for key in replacer_values.keys():
-            if key in truncable_replacers.keys():
-                truncable_len += len(replacer_values[key])
-
-        budget_remaining = (
-            budget - len(basepath) - ((len(template) - keys_len) + values_len)
-        )
+        items, literal_len, parts = __compile_template(template)
+        performer_names = __get_performer_names(scene)
+
+        for key, replacer, truncable in items:
+            value = replacer(scene, performer_names)
+            replacer_values[key] = value
+            values_len += len(value)
+            if truncable:
+                truncable_keys.append(key)
+                truncable_len += len(value)
+
+        budget_remaining = budget - len(basepath) - (literal_len + values_len)
         if (budget_remaining + truncable_len) < 0:
             raise ValueError(
                 "Filepath would exceed your renamer_filename_budget. If your system allows, consider raising the value. Windows systems can now have their filepath limitation increased, a quick search will yield instructions for doing this. If the value cannot be increased, consider adjusting your renamer_path_template or the Scene title if applicable."
             )
 
-        filename = template
+        for key in truncable_keys:
+            trunced = replacer_values[key][:budget_remaining]
+            budget_remaining -= len(trunced)
+            replacer_values[key] = trunced
 
-        for key in replacer_values.keys():
-            value = replacer_values[key]
-
-            if key in truncable_replacers.keys():
-                trunced = value[:budget_remaining]
-                budget_remaining -= len(trunced)
-                value = trunced
-
-            filename = re.sub(__get_replacer_regex(key), value, filename)
+        filename = "".join(
+            replacer_values[part] if i % 2 else part for i, part in enumerate(parts)
+        )
 
     except ValueError as err:
         log.error(f"Skipping renaming Scene ID {scene['id']}: {str(err)}")
@@ -235,22 +223,19 @@ def get_new_path(scene, basepath, template, budget):
         log.error(f"Unexpected error renaming Scene ID {scene['id']}:{str(err)}")
         return False
 
-    new_path = basepath + __trim_filename(filename) + ext
+    new_path = f"{basepath}{__trim_filename(filename)}{ext}"
     log.debug(f"New Path: {new_path}")
     return new_path
 
 
 def __trim_filename(filename):
-    empty_brackets_removed = re.sub(r"\[\]", "", filename)
-    empty_parens_removed = re.sub(r"\(\)", "", empty_brackets_removed)
-    multiple_spaces_replaced = re.sub(r"\s{2,}", " ", empty_parens_removed)
-    multiple_hyphens_removed = re.sub(r"-{2,}", "-", multiple_spaces_replaced)
+    empty_groups_removed = EMPTY_GROUPS_REGEX.sub("", filename)
+    separators_collapsed = REPEATED_SEPARATORS_REGEX.sub(
+        lambda match: "-" if match[0][0] == "-" else " ", empty_groups_removed
+    )
 
-    return multiple_hyphens_removed.strip()
+    return separators_collapsed.strip()
 
 
 def __replace_invalid_file_chars(filename):
-    safe = re.sub(r'[<>\\/\?\*"\|]', " ", filename)
-    safe = re.sub(r"[:]", "-", safe)
-    safe = re.sub(r"[&]", "and", safe)
-    return safe
+    return filename.translate(INVALID_FILE_CHARS_TABLE).replace("&", "and")
@@ -1,4 +1,3 @@
-import configparser
 import os
 import re
 import sys
@@ -23,6 +22,19 @@ SETTINGS_BOOLEANS = [
     "renamer_ignore_files_in_path",
     "renamer_enable_mark_organized",
 ]
+BOOLEAN_STRINGS = {
+    "1": True,
+    "yes": True,
+    "true": True,
+    "on": True,
+    "0": False,
+    "no": False,
+    "false": False,
+    "off": False,
+}
+SETTINGS_SECTION = "settings"
+# key, then value after the first delimiter
+SETTINGS_LINE_REGEX = re.compile(r"([^=:]+)[=:](.*)")
 VALID_MEDIA_SERVERS = ["emby", "jellyfin"]
 
 
@@ -32,11 +44,17 @@ def __validate_boolean(name, value):
 
 
 def validate_actor_metadata_path(settings):
-    if settings["enable_actor_images"]:
-        if not os.path.exists(settings["actor_metadata_path"]):  # pragma: no cover
-            raise SystemError(
-                f"actor_metadata_path is invalid or you don't have sufficient permissions to this location: {settings['actor_metadata_path']}"
-            )
+    if not os.path.exists(settings["actor_metadata_path"]):  # pragma: no cover
+        raise SystemError(
+            f"actor_metadata_path is invalid or you don't have sufficient permissions to this location: {settings['actor_metadata_path']}"
+        )
+
+
+def validate_download_concurrency(settings):
+    if settings.get("download_concurrency"):
+        value = int(settings["download_concurrency"])
+        if value < 1 or value > 64:
+            raise ValueError("download_concurrency should be a number between 1 and 64")
 
 
 def validate_dry_run(settings):
@@ -56,29 +74,24 @@ def validate_enable_renamer(settings):
 
 
 def validate_media_server(settings):
-    if settings["enable_actor_images"]:
-        if settings["media_server"] not in VALID_MEDIA_SERVERS:
-            raise ValueError(
-                f"Valid media_server values are: {str(VALID_MEDIA_SERVERS)}"
-            )
+    if settings["media_server"] not in VALID_MEDIA_SERVERS:
+        raise ValueError(f"Valid media_server values are: {str(VALID_MEDIA_SERVERS)}")
 
 
 def validate_renamer_ignore_files_in_path(settings):
-    if settings["enable_renamer"]:
-        __validate_boolean(
-            "renamer_ignore_files_in_path", settings["renamer_ignore_files_in_path"]
-        )
+    __validate_boolean(
+        "renamer_ignore_files_in_path", settings["renamer_ignore_files_in_path"]
+    )
 
 
 def validate_renamer_enable_mark_organized(settings):
-    if settings["enable_renamer"]:
-        __validate_boolean(
-            "renamer_enable_mark_organized", settings["renamer_enable_mark_organized"]
-        )
+    __validate_boolean(
+        "renamer_enable_mark_organized", settings["renamer_enable_mark_organized"]
+    )
 
 
 def validate_renamer_filename_budget(settings):
-    if settings["renamer_filename_budget"]:
+    if settings.get("renamer_filename_budget"):
         value = int(settings["renamer_filename_budget"])
         if value < 40 or value > 800:
             raise ValueError(
@@ -87,65 +100,61 @@ def validate_renamer_filename_budget(settings):
 
 
 def validate_renamer_path(settings):  # pragma: no cover
-    if settings["enable_renamer"]:
-        try:
-            if not os.path.exists(settings["renamer_path"]):
-                os.makedirs(settings["renamer_path"])
-                if not os.path.exists(settings["renamer_path"]):
-                    raise SystemError(
-                        f"Failed to create directory {settings['renamer_path']}"
-                    )
-
-        except Exception as err:
-            log.error(
-                f"renamer_path is invalid or you don't have sufficient permissions to this location: {str(err)}"
-            )
-            raise SystemError(err)
+    try:
+        # makedirs raises when the directory can't be created, no need to check again
+        os.makedirs(settings["renamer_path"], exist_ok=True)
+    except Exception as err:
+        log.error(
+            f"renamer_path is invalid or you don't have sufficient permissions to this location: {str(err)}"
+        )
+        raise SystemError(err)
 
 
 def validate_renamer_path_template(settings):
-    if settings["enable_renamer"]:
-        is_valid_uniqueness = False
-        for uniquenessKeys in VALID_TEMPLATE_UNIQUENESS:
-            has_all = True
-            for key in uniquenessKeys:
-                if key not in settings["renamer_path_template"]:
-                    has_all = False
-                    break
-            if has_all is True:
-                is_valid_uniqueness = True
-                break
-        if is_valid_uniqueness is False:
-            raise ValueError("renamer_path_template does not meet the uniqueness rules")
-
-        stripped_template = settings["renamer_path_template"]
-        for key in VALID_TEMPLATE_VARS:
-            stripped_template = stripped_template.replace(key, "")
-
-        if INVALID_TEMPLATE_REGEX.search(stripped_template):
-            raise ValueError(
-                f"renamer_path_template contains an invalid char. Invalid chars: {str(INVALID_TEMPLATE_CHARS)}"
-            )
+    present_vars = set(TEMPLATE_TOKENS_REGEX.findall(settings["renamer_path_template"]))
+    if not any(keys.issubset(present_vars) for keys in VALID_TEMPLATE_UNIQUENESS):
+        raise ValueError("renamer_path_template does not meet the uniqueness rules")
 
+    stripped_template = TEMPLATE_VARS_REGEX.sub("", settings["renamer_path_template"])
+
+    if not INVALID_TEMPLATE_CHARS_SET.isdisjoint(stripped_template):
+        raise ValueError(
+            f"renamer_path_template contains an invalid char. Invalid chars: {str(INVALID_TEMPLATE_CHARS)}"
+        )
 
-SETTINGS_VALIDATORS = {
-    "actor_metadata_path": validate_actor_metadata_path,
-    "dry_run": validate_dry_run,
-    "enable_actor_images": validate_enable_actor_images,
-    "enable_hook": validate_enable_hook,
-    "enable_renamer": validate_enable_renamer,
-    "media_server": validate_media_server,
-    "renamer_ignore_files_in_path": validate_renamer_ignore_files_in_path,
-    "renamer_enable_mark_organized": validate_renamer_enable_mark_organized,
-    "renamer_filename_budget": validate_renamer_filename_budget,
-    "renamer_path": validate_renamer_path,
-    "renamer_path_template": validate_renamer_path_template,
-}
+
+def validate_scene_parallelism(settings):
+    if settings.get("scene_parallelism"):
+        value = int(settings["scene_parallelism"])
+        if value < 1 or value > 64:
+            raise ValueError("scene_parallelism should be a number between 1 and 64")
+
+
+# validators grouped like the required settings, so the feature toggles are only checked once
+SETTINGS_VALIDATORS = [
+    validate_download_concurrency,
+    validate_dry_run,
+    validate_enable_actor_images,
+    validate_enable_hook,
+    validate_enable_renamer,
+    validate_scene_parallelism,
+]
+SETTINGS_VALIDATORS_IF_RENAMER = [
+    validate_renamer_ignore_files_in_path,
+    validate_renamer_enable_mark_organized,
+    validate_renamer_filename_budget,
+    validate_renamer_path,
+    validate_renamer_path_template,
+]
+SETTINGS_VALIDATORS_IF_ACTORS = [
+    validate_actor_metadata_path,
+    validate_media_server,
+]
 
 # renamer template constants
 INVALID_SEP = "\\" if os.path.sep == "/" else "/"
 INVALID_TEMPLATE_CHARS = "".join(["<", ">", ":", '"', INVALID_SEP, "|", "?", "*"])
-INVALID_TEMPLATE_REGEX = re.compile(r"[" + re.escape(INVALID_TEMPLATE_CHARS) + r"]")
+INVALID_TEMPLATE_CHARS_SET = frozenset(INVALID_TEMPLATE_CHARS)
 
 VALID_TEMPLATE_VARS = [
     "$FemalePerformers",
@@ -162,23 +171,91 @@ VALID_TEMPLATE_VARS = [
     "$Title",
 ]
 
+# strips every variable in one pass, longest first so $Studios isn't stripped as $Studio
+TEMPLATE_VARS_REGEX = re.compile(
+    "|".join(
+        re.escape(var) for var in sorted(VALID_TEMPLATE_VARS, key=len, reverse=True)
+    )
+)
+
+# a variable runs until the first non-letter, the same way the replacer matches them
+TEMPLATE_TOKENS_REGEX = re.compile(r"\$[a-zA-Z]+")
+
 VALID_TEMPLATE_UNIQUENESS = [
-    ["$StashID"],
-    ["$Studio", "$Title", "$ReleaseDate"],
-    ["$Studios", "$Title", "$ReleaseDate"],
+    frozenset(["$StashID"]),
+    frozenset(["$Studio", "$Title", "$ReleaseDate"]),
+    frozenset(["$Studios", "$Title", "$ReleaseDate"]),
 ]
 
 
-parser = configparser.ConfigParser()
 settings = {}
 
 
+def parse_settings(text):
+    # settings.ini is a single flat section, so it doesn't need the whole of configparser
+    parsed = {}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line[0] == "[" and line[-1] == "]":
+            section = line[1:-1].strip()
+            continue
+        if section != SETTINGS_SECTION:
+            continue
+        # like configparser, a key ends at the first "=" or ":"
+        match = SETTINGS_LINE_REGEX.match(line)
+        if match is None:
+            continue
+        key = match[1].strip().lower()
+        # configparser's interpolation needs a literal % written as %%
+        value = match[2].strip().replace("%%", "%")
+        # coerce booleans to booleans, anything else is left for the validators to report
+        if key in SETTINGS_BOOLEANS:
+            value = BOOLEAN_STRINGS.get(value.lower(), value)
+        parsed[key] = value
+    return parsed
+
+
+def replace_setting(text, key, value):
+    # only rewrite the line holding the key, so comments and layout in settings.ini survive
+    lines = text.splitlines()
+    setting_line = f"{key} = {value}"
+    section = None
+    # where a missing key goes, right after the last setting of the settings section
+    insert_at = None
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if line[:1] == "[" and line[-1:] == "]":
+            section = line[1:-1].strip()
+            if section == SETTINGS_SECTION:
+                insert_at = i + 1
+            continue
+        if section != SETTINGS_SECTION or not line or line[0] in "#;":
+            continue
+        match = SETTINGS_LINE_REGEX.match(line)
+        if match is None:
+            continue
+        if match[1].strip().lower() == key:
+            lines[i] = setting_line
+            break
+        insert_at = i + 1
+    else:
+        if insert_at is None:
+            lines += [f"[{SETTINGS_SECTION}]", setting_line]
+        else:
+            lines.insert(insert_at, setting_line)
+    return "\n".join(lines) + "\n"
+
+
 def update_setting(filepath, key, value):  # pragma: no cover
     try:
         log.debug(f"Updating setting {key} to {str(value)}")
-        parser.set("settings", key, value)
+        with open(filepath, "r") as f:
+            text = f.read()
         with open(filepath, "w") as f:
-            parser.write(f)
+            f.write(replace_setting(text, key, value))
             log.info(f"{key} set to {value}")
     except PermissionError as err:
         log.error(f"You don't have the permission to edit settings.ini ({err})")
@@ -187,14 +264,8 @@ def update_setting(filepath, key, value):  # pragma: no cover
 def read_settings(filepath):  # pragma: no cover
     log.debug(f"Reading settings file at {filepath}")
     try:
-        parser.read(filepath)
-
-        for key, value in parser.items("settings"):
-            # coerce booleans to booleans
-            if key in SETTINGS_BOOLEANS:
-                settings[key] = parser.getboolean("settings", key)
-            else:
-                settings[key] = value
+        with open(filepath, "r") as f:
+            settings.update(parse_settings(f.read()))
 
         is_valid = validate_settings(settings)
         if is_valid is False:
@@ -209,29 +280,33 @@ def read_settings(filepath):  # pragma: no cover
 def validate_settings(settings):
     log.debug("Validating settings")
     # check for existence of necessary fields in settings
-    try:
-        # required fields (will throw if not found)
-        for key in REQUIRED_SETTINGS:
-            settings[key]
-
+    missing = [key for key in REQUIRED_SETTINGS if key not in settings]
+    if not missing:
+        optional = []
         # optional fields (only needed if enable_renamer is True)
         if settings["enable_renamer"]:
-            for key in REQUIRED_SETTINGS_IF_RENAMER:
-                settings[key]
-
+            optional += REQUIRED_SETTINGS_IF_RENAMER
         # optional fields (only needed if enable_actor_images is True)
         if settings["enable_actor_images"]:
-            for key in REQUIRED_SETTINGS_IF_ACTORS:
-                settings[key]
-    except KeyError as key:
-        log.error(
-            f"{str(key)} is not defined in settings.ini, but is needed for this script to proceed"
-        )
+            optional += REQUIRED_SETTINGS_IF_ACTORS
+        missing = [key for key in optional if key not in settings]
+
+    if missing:
+        for key in missing:
+            log.error(
+                f"'{key}' is not defined in settings.ini, but is needed for this script to proceed"
+            )
         return False
 
+    validators = SETTINGS_VALIDATORS
+    if settings["enable_renamer"] is True:
+        validators = validators + SETTINGS_VALIDATORS_IF_RENAMER
+    if settings["enable_actor_images"] is True:
+        validators = validators + SETTINGS_VALIDATORS_IF_ACTORS
+
     try:
-        for key in SETTINGS_VALIDATORS.keys():
-            SETTINGS_VALIDATORS[key](settings)
+        for validator in validators:
+            validator(settings)
         return True
     except Exception as err:
         log.error(str(err))